@@ -10,9 +10,23 @@
 # Distributed under an GPLv2 license, please see LICENSE in the top dir.
 
 import libcredit
+import rdflib
 from xml.dom import minidom
 import tempfile, os
 import uuid
+import contextlib
+import hashlib
+import collections
+import threading
+import io
+import re
+import codecs
+
+# Pillow is optional, without it images are always pasted at full size
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 import uno
 import unohelper
@@ -40,13 +54,111 @@ from com.sun.star.text.ControlCharacter import PARAGRAPH_BREAK
 from com.sun.star.text.TextContentAnchorType import AS_CHARACTER
 from com.sun.star.text.TextContentAnchorType import AT_PARAGRAPH
 from com.sun.star.rdf.FileFormat import RDF_XML
+from com.sun.star.embed.ElementModes import READ
 from com.sun.star.ui.ActionTriggerSeparatorType import LINE
 
 from com.sun.star.container import NoSuchElementException
+from com.sun.star.rdf import ParseException
+from com.sun.star.io import IOException
 
 
 BOOKMARK_BASE_NAME = "$metadata-tag-do-not-edit$"
 
+# Limits for the sources written inline in pasted captions.  Sources
+# beyond these are summarized as "+N more sources".  The full chain of
+# sources is still recorded in the document metadata, since the pasted
+# RDF is imported as it is.  None means no limit.
+CAPTION_SOURCE_DEPTH = 1
+CAPTION_SOURCES_PER_LEVEL = 5
+
+# Approximate memory, in bytes, used by decoded graphics kept around
+# for repeated pastes
+GRAPHIC_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+_graphic_cache = collections.OrderedDict()
+_graphic_cache_bytes = 0
+_graphic_cache_lock = threading.Lock()
+
+# Width of the frame holding pasted images in Writer, in 1/100 mm
+CAPTION_FRAME_WIDTH = 15000
+
+# Limits for "Paste with credits (reduced size)".  Images are scaled
+# down to at most DOWNSAMPLE_MAX_PIXELS on either side, and to at most
+# DOWNSAMPLE_MAX_DPI at the size they are shown in Writer.  Only
+# still images in DOWNSAMPLE_FORMATS are scaled down, and are saved in
+# the same format, using DOWNSAMPLE_QUALITY for lossy formats.
+DOWNSAMPLE_MAX_PIXELS = 2048
+DOWNSAMPLE_MAX_DPI = 300
+DOWNSAMPLE_QUALITY = 85
+DOWNSAMPLE_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+# Limits for the metadata accepted on paste.  If the clipboard RDF is
+# larger than MAX_RDF_SIZE bytes, has more than MAX_RDF_TRIPLES
+# statements, sources nested deeper than MAX_RDF_SOURCE_DEPTH or would
+# give more than MAX_RDF_CREDITS credits when the sources are expanded
+# into a tree, the image is pasted without credits.
+MAX_RDF_SIZE = 1024 * 1024
+MAX_RDF_TRIPLES = 10000
+MAX_RDF_SOURCE_DEPTH = 20
+MAX_RDF_CREDITS = 1000
+
+XML_DECLARATION_RE = re.compile(br'^\s*<\?xml[^>]*\?>')
+XML_ENCODING_RE = re.compile(br'\sencoding=["\']([A-Za-z0-9._-]+)["\']')
+
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+
+# Namespace for the statements this extension records about pasted
+# images, as opposed to the metadata of the works themselves
+PASTE_NS = 'http://commonsmachinery.se/ns/paste-with-credit#'
+
+# Predicate for the hash of the metadata a caption was written from
+CREDIT_HASH_URI = PASTE_NS + 'creditHash'
+CREDIT_HASH = rdflib.URIRef(CREDIT_HASH_URI)
+
+# Predicate for the SHA-1 of the image data that was pasted
+IMAGE_HASH_URI = PASTE_NS + 'imageHash'
+
+# Predicates for the pixel size of images pasted with reduced size
+ORIGINAL_WIDTH_URI = PASTE_NS + 'originalWidth'
+ORIGINAL_HEIGHT_URI = PASTE_NS + 'originalHeight'
+
+# Image formats accepted with credits, in order of preference.  PNG is
+# last since it is usually a conversion of one of the others.
+IMAGE_MIME_TYPES = (
+    "image/jpeg",
+    "image/webp",
+    "image/gif",
+    "image/svg+xml",
+    "image/png",
+)
+
+
+class CreditError(Exception):
+    """Raised when pasted metadata can't be turned into a credit."""
+    pass
+
+
+class CreditLimitError(CreditError):
+    """Raised when pasted metadata exceeds one of the MAX_RDF limits."""
+    pass
+
+
+class BoundedGraph(rdflib.Graph):
+    """
+    Graph that raises CreditLimitError when more than max_triples
+    statements are added, so that parsing stops early.
+    """
+    def __init__(self, max_triples):
+        rdflib.Graph.__init__(self)
+        self.max_triples = max_triples
+        self.triple_count = 0
+
+    def add(self, triple):
+        self.triple_count += 1
+        if self.triple_count > self.max_triples:
+            raise CreditLimitError('more than {0} statements'.format(self.max_triples))
+        return rdflib.Graph.add(self, triple)
+
 
 class StringOutputStream(unohelper.Base, XOutputStream):
     def __init__(self):
@@ -82,10 +194,445 @@ def copy_statements(repository, subject, seen_subjects, graph):
                 # Recurse over non-literal
                 copy_statements(repository, s.Object, seen_subjects, graph)
 
+def read_stream(input_stream):
+    """Return all data in an XInputStream as bytes."""
+    chunks = []
+    while True:
+        count, data = input_stream.readBytes(None, 65536)
+        if count == 0:
+            break
+        chunks.append(data.value)
+    return b''.join(chunks)
+
 def uri(ctx, string):
     return ctx.ServiceManager.createInstanceWithArguments(
         "com.sun.star.rdf.URI", (string, ))
 
+@contextlib.contextmanager
+def edit_batch(model, title):
+    """
+    Context manager that groups the edits made to model into a single
+    undo action, and keeps the views from reformatting until it exits.
+    """
+    undo_manager = model.getUndoManager()
+
+    model.lockControllers()
+    try:
+        undo_manager.enterUndoContext(title)
+        try:
+            yield
+        finally:
+            undo_manager.leaveUndoContext()
+    finally:
+        model.unlockControllers()
+
+def decode_rdf(data):
+    """
+    Decode RDF/XML data, using the encoding given by the byte order
+    mark or the XML declaration.  Defaults to UTF-8.  The declaration
+    is left out, so that the result can be parsed again as UTF-8.
+    """
+    if data.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+    elif data.startswith((codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE)):
+        encoding = 'utf-32'
+    elif data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        encoding = 'utf-16'
+    elif data.startswith(b'<\x00'):
+        encoding = 'utf-16-le'
+    elif data.startswith(b'\x00<'):
+        encoding = 'utf-16-be'
+    else:
+        encoding = 'utf-8'
+        declaration = XML_DECLARATION_RE.match(data)
+        if declaration:
+            match = XML_ENCODING_RE.search(declaration.group(0))
+            if match:
+                encoding = match.group(1).decode('ascii')
+            data = data[declaration.end():]
+
+    try:
+        text = data.decode(encoding)
+    except LookupError:
+        text = data.decode('utf-8')
+
+    # Multi-byte encodings can only be matched once decoded
+    return re.sub(r'^\s*<\?xml[^>]*\?>', '', text)
+
+def get_sources(graph, subject):
+    """Return the sources of subject in graph, as libcredit finds them."""
+    return (list(graph.objects(subject, libcredit.DC['source'])) +
+            list(graph.objects(subject, libcredit.DCTERMS['source'])))
+
+def add_original_size(rdf, img_size):
+    """
+    Return the RDF/XML string rdf with the original size of the pasted
+    image added, as statements about the image itself (rdf:about="").
+    """
+    doc = minidom.parseString(rdf.encode('utf-8'))
+    root = doc.documentElement
+
+    description = doc.createElementNS(RDF_NS, 'rdf:Description')
+    description.setAttribute('xmlns:rdf', RDF_NS)
+    description.setAttribute('xmlns:pwc', PASTE_NS)
+    description.setAttributeNS(RDF_NS, 'rdf:about', '')
+    for name, value in (('originalWidth', img_size.Width),
+                        ('originalHeight', img_size.Height)):
+        element = doc.createElementNS(PASTE_NS, 'pwc:' + name)
+        element.appendChild(doc.createTextNode(str(value)))
+        description.appendChild(element)
+
+    if root.namespaceURI != RDF_NS or root.localName != 'RDF':
+        # A single node element can be the document element in
+        # RDF/XML, so wrap it to make room for more
+        doc.removeChild(root)
+        rdf_root = doc.createElementNS(RDF_NS, 'rdf:RDF')
+        rdf_root.setAttribute('xmlns:rdf', RDF_NS)
+        rdf_root.appendChild(root)
+        doc.appendChild(rdf_root)
+        root = rdf_root
+
+    root.appendChild(description)
+    return root.toxml()
+
+def check_source_tree(graph, max_depth, max_credits, subject=None):
+    """
+    Raise CreditLimitError if the sources of subject, or of the work in
+    graph if None, are nested deeper than max_depth, or if libcredit
+    would create more than max_credits credits for them.
+
+    libcredit expands shared sources into a tree, so each level counts
+    the number of paths to a source rather than distinct sources.
+    Loops count as too deep.
+    """
+    if subject is None:
+        level = collections.Counter(
+            graph.objects(libcredit.a2uri(''), libcredit.DC['source']))
+    else:
+        level = collections.Counter(get_sources(graph, subject))
+    depth = 0
+    total = 0
+
+    while level:
+        if depth > max_depth:
+            raise CreditLimitError('sources nested deeper than {0}'.format(max_depth))
+
+        total += sum(level.values())
+        if total > max_credits:
+            raise CreditLimitError('more than {0} credits'.format(max_credits))
+
+        next_level = collections.Counter()
+        for source, paths in level.items():
+            for source_of_source in get_sources(graph, source):
+                next_level[source_of_source] += paths
+
+        level = next_level
+        depth += 1
+
+def parse_credit(rdf):
+    """
+    Parse RDF/XML into a libcredit.Credit.  rdf should be the raw bytes,
+    so that the XML parser can detect the encoding.
+
+    Raises CreditLimitError if it exceeds MAX_RDF_TRIPLES,
+    MAX_RDF_SOURCE_DEPTH or MAX_RDF_CREDITS, and CreditError if it
+    can't be parsed.
+    """
+    graph = BoundedGraph(MAX_RDF_TRIPLES)
+    try:
+        graph.parse(source=io.BytesIO(rdf), format='xml')
+        check_source_tree(graph, MAX_RDF_SOURCE_DEPTH, MAX_RDF_CREDITS)
+        return libcredit.Credit(graph)
+    except CreditError:
+        raise
+    except Exception as e:
+        # rdflib and libcredit can raise just about anything on bad input
+        raise CreditError(str(e))
+
+def get_document_credit(graph, subject):
+    """
+    Return a libcredit.Credit for subject in graph, which holds the
+    metadata of a document.  That combines the metadata of every paste,
+    so the sources are checked against the same limits as on paste.
+
+    Raises CreditError if they exceed them.
+    """
+    try:
+        check_source_tree(graph, MAX_RDF_SOURCE_DEPTH, MAX_RDF_CREDITS, subject)
+        return libcredit.Credit(graph, subject=subject)
+    except CreditError:
+        raise
+    except Exception as e:
+        raise CreditError(str(e))
+
+def find_image_flavor(data_flavors):
+    """Return the preferred image flavor in data_flavors, or None."""
+    for mime_type in IMAGE_MIME_TYPES:
+        for flavor in data_flavors:
+            if flavor.MimeType == mime_type:
+                return flavor
+    return None
+
+def get_cached_graphic(key):
+    """Return the cached value for key, or None."""
+    with _graphic_cache_lock:
+        entry = _graphic_cache.pop(key, None)
+        if entry is None:
+            return None
+
+        # Move to the end as the most recently used
+        _graphic_cache[key] = entry
+        return entry[0]
+
+def cache_graphic(key, value, size):
+    """
+    Cache value for key.  size is the pixel Size of the decoded graphic,
+    used to estimate the memory it takes.  Least recently used entries
+    are dropped to stay within GRAPHIC_CACHE_MAX_BYTES.
+    """
+    global _graphic_cache_bytes
+
+    nbytes = size.Width * size.Height * 4
+    if nbytes > GRAPHIC_CACHE_MAX_BYTES:
+        return
+
+    with _graphic_cache_lock:
+        old_entry = _graphic_cache.pop(key, None)
+        if old_entry is not None:
+            _graphic_cache_bytes -= old_entry[1]
+
+        _graphic_cache[key] = (value, nbytes)
+        _graphic_cache_bytes += nbytes
+
+        while _graphic_cache_bytes > GRAPHIC_CACHE_MAX_BYTES:
+            old_key, old_entry = _graphic_cache.popitem(last=False)
+            _graphic_cache_bytes -= old_entry[1]
+
+def decode_graphic(ctx, data):
+    """
+    Return a (SizePixel, Graphic) tuple for the image in data.  Vector
+    graphics have no pixel size, so they get the one that is pasted at
+    their own size.
+    """
+    img_stream = ctx.ServiceManager.createInstanceWithContext(
+        "com.sun.star.io.SequenceInputStream", ctx)
+    img_stream.initialize((data,))
+    graphic_provider = ctx.ServiceManager.createInstanceWithContext(
+        "com.sun.star.graphic.GraphicProvider", ctx)
+
+    stream_property = PropertyValue()
+    stream_property.Name = "InputStream"
+    stream_property.Value = img_stream
+
+    descriptor = graphic_provider.queryGraphicDescriptor((stream_property,))
+    graphic = graphic_provider.queryGraphic((stream_property,))
+
+    size = descriptor.getPropertyValue("SizePixel")
+    if not size.Width or not size.Height:
+        # Images are pasted at 20 1/100 mm per pixel
+        size_100th_mm = descriptor.getPropertyValue("Size100thMM")
+        size = Size(max(1, size_100th_mm.Width // 20),
+                    max(1, size_100th_mm.Height // 20))
+
+    return (size, graphic)
+
+def load_graphic(ctx, data):
+    """
+    Return a (SizePixel, Graphic) tuple for the image in data.
+
+    Graphics are cached by a hash of the image data, so pasting the
+    same image again reuses the Graphic object.  All objects sharing a
+    Graphic are stored as a single image in the document package.
+    """
+    key = hashlib.sha1(data.value).hexdigest()
+
+    result = get_cached_graphic(key)
+    if result is None:
+        result = decode_graphic(ctx, data)
+        cache_graphic(key, result, result[0])
+
+    return result
+
+def downsampled_graphic_key(data, max_size):
+    """
+    Return the graphic cache key for the image in data scaled down to
+    max_size, so that it can be found before scaling it again.
+    """
+    return '{0}@{1}x{2}'.format(hashlib.sha1(data).hexdigest(), *max_size)
+
+class ImageDownsampler(threading.Thread):
+    """
+    Worker thread that scales image data down to fit within max_size
+    and recompresses it.
+
+    When done, data holds the new image data, or None if the image is
+    already small enough, is animated, or couldn't be read or saved in
+    the same format.  original_size holds the
+    (width, height) of the original image.  If on_done is given, it is
+    then called with the downsampler in the worker thread.
+    """
+    def __init__(self, data, max_size, on_done=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.src = data
+        self.max_size = max_size
+        self.on_done = on_done
+        self.data = None
+        self.original_size = None
+
+    def run(self):
+        self._downsample()
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def _downsample(self):
+        try:
+            image = Image.open(io.BytesIO(self.src))
+            self.original_size = image.size
+
+            if (image.size[0] <= self.max_size[0] and
+                image.size[1] <= self.max_size[1]):
+                return
+
+            image_format = image.format
+            if (image_format not in DOWNSAMPLE_FORMATS or
+                getattr(image, 'is_animated', False)):
+                # Saving as PNG would lose animations or make the
+                # image larger, so keep the original
+                return
+
+            image.thumbnail(self.max_size, Image.LANCZOS)
+
+            out = io.BytesIO()
+            if image_format == 'PNG':
+                image.save(out, 'PNG', optimize=True)
+            else:
+                image.save(out, image_format, quality=DOWNSAMPLE_QUALITY, optimize=True)
+            self.data = out.getvalue()
+        except Exception:
+            # Fall back to pasting the original image
+            self.data = None
+
+def rdflib_node(node):
+    if hasattr(node, 'Value'):
+        if node.Datatype is not None:
+            return rdflib.Literal(node.Value, datatype=node.Datatype.StringValue)
+        return rdflib.Literal(node.Value, lang=node.Language or None)
+    if hasattr(node, 'LocalName'):
+        return rdflib.URIRef(node.StringValue)
+    return rdflib.BNode(node.StringValue)
+
+def get_repository_graph(repository):
+    """
+    Return an rdflib graph with all statements in the repository,
+    including RDFa, read with a single getStatements call.
+    """
+    graph = rdflib.Graph()
+
+    statements = repository.getStatements(None, None, None)
+    while statements.hasMoreElements():
+        s = statements.nextElement()
+        graph.add((rdflib_node(s.Subject),
+                   rdflib_node(s.Predicate),
+                   rdflib_node(s.Object)))
+
+    return graph
+
+def get_closure_graph(repository, subject):
+    """
+    Return an rdflib graph with the statements in the repository that
+    can be reached from subject.
+    """
+    graph = rdflib.Graph()
+    seen_subjects = set([subject.StringValue])
+    subjects = [subject]
+
+    while subjects:
+        statements = repository.getStatements(subjects.pop(), None, None)
+        while statements.hasMoreElements():
+            s = statements.nextElement()
+            graph.add((rdflib_node(s.Subject),
+                       rdflib_node(s.Predicate),
+                       rdflib_node(s.Object)))
+
+            if not hasattr(s.Object, 'Value') and s.Object.StringValue not in seen_subjects:
+                seen_subjects.add(s.Object.StringValue)
+                subjects.append(s.Object)
+
+    return graph
+
+def provenance_hash(graph, subject):
+    """
+    Return a hash of the statements in graph that can be reached from
+    subject, ignoring the statements this extension records about the
+    pasted image, such as the stored credit hash.
+    """
+    lines = []
+    seen_subjects = set([subject])
+    subjects = [subject]
+
+    while subjects:
+        node = subjects.pop()
+        for predicate, obj in graph.predicate_objects(node):
+            if predicate.startswith(PASTE_NS):
+                continue
+
+            lines.append(u' '.join((node.n3(), predicate.n3(), obj.n3())))
+
+            if not isinstance(obj, rdflib.Literal) and obj not in seen_subjects:
+                seen_subjects.add(obj)
+                subjects.append(obj)
+
+    lines.sort()
+    return hashlib.sha1(u'\n'.join(lines).encode('utf-8')).hexdigest()
+
+def count_sources(credit, counts):
+    """
+    Return the number of sources below credit, counting sources of
+    sources too.  The counts for credit and its sources are also stored
+    in counts, keyed by subject URI.
+    """
+    count = 0
+    for source in credit.sources:
+        count += 1 + count_sources(source, counts)
+
+    counts[credit.get_subject_uri()] = count
+    return count
+
+def write_credit(credit, text, cursor, image, metadata, bookmark):
+    """
+    Write credit as the caption at cursor, and as the title (no
+    sources) and description (credit with sources) of image, in a
+    single pass over the credit.
+    """
+    source_counts = {}
+    source_counts[bookmark.StringValue] = count_sources(credit, source_counts)
+
+    caption_writer = LOCreditFormatter(
+        text, cursor, metadata = metadata,
+        source_depth = CAPTION_SOURCE_DEPTH,
+        sources_per_level = CAPTION_SOURCES_PER_LEVEL,
+        source_counts = source_counts)
+    title_writer = libcredit.TextCreditFormatter()
+    description_writer = libcredit.TextCreditFormatter()
+
+    # The caption needs to see one level below the written sources to
+    # know where to summarize the rest
+    if CAPTION_SOURCE_DEPTH is None:
+        caption_depth = -1
+    else:
+        caption_depth = CAPTION_SOURCE_DEPTH + 1
+
+    tee = TeeCreditFormatter(
+        (caption_writer, caption_depth),
+        (title_writer, 0),
+        (description_writer, 1))
+    credit.format(tee, source_depth = tee.source_depth,
+                  subject_uri = bookmark.StringValue)
+
+    image.setPropertyValue("Title", title_writer.get_text())
+    image.setPropertyValue("Description", description_writer.get_text())
+
 def get_image_metadata(ctx, model, name):
 
     bookmark = model.getBookmarks().getByName(name)
@@ -115,8 +662,18 @@ def get_image_metadata(ctx, model, name):
 class LOCreditFormatter(libcredit.CreditFormatter):
     """
     Credit writer that adds text to LibreOffice writer document using UNO.
+
+    source_depth and sources_per_level limit how many levels of sources,
+    and how many sources on each level, are written as text.  The rest
+    are summarized as "+N more sources", counting sources of sources
+    too if source_counts maps subject URIs to those totals.  Metadata is
+    only added for the written sources, and dc:source statements only
+    for the work itself, so the full chain must be added to the
+    metadata separately.
     """
-    def __init__(self, text, cursor, hyperlinks=True, metadata = None):
+    def __init__(self, text, cursor, hyperlinks=True, metadata = None,
+                 source_depth = None, sources_per_level = None,
+                 source_counts = None):
         self.text = text
         self.cursor = cursor
         self.cursor.collapseToEnd()
@@ -127,15 +684,42 @@ class LOCreditFormatter(libcredit.CreditFormatter):
         self.subject_stack = []
         self.current_subject = None
 
+        self.source_depth = source_depth
+        self.sources_per_level = sources_per_level
+        self.source_counts = source_counts
+
+        self.uri_stack = []
+
+        # One [hidden, count, below] entry for each open list of
+        # sources, where below is the number of sources of the hidden
+        # sources in the list
+        self.sources_stack = []
+
+        # Nesting count of hidden sources; nothing is written while > 0
+        self.hidden = 0
+
+        # Entry of the list a skipped source is in, until its begin()
+        self.skipped_entry = None
+
     def begin(self, subject_uri=None):
+        if self.skipped_entry is not None:
+            self.skipped_entry[2] += self._count_sources(subject_uri, 0)
+            self.skipped_entry = None
+
         if self.metadata:
-            if subject_uri is not None:
+            # Only sources that are written, or linked from the work
+            # itself, need a subject.  libcredit passes blank nodes as
+            # their bare ID, which isn't a URI.
+            if (subject_uri is not None and ':' in subject_uri and
+                (not self.hidden or len(self.subject_stack) == 1)):
                 new_subject = self.metadata.uri(subject_uri)
             else:
                 new_subject = None
 
-            if self.current_subject is not None and new_subject is not None:
-                # Generate a dc:source statement from the previous level
+            if (len(self.subject_stack) == 1 and
+                self.current_subject is not None and new_subject is not None):
+                # Generate a dc:source statement from the work itself,
+                # the rest of the chain is in the pasted metadata
                 self.metadata.add_statement(
                     self.current_subject,
                     self.metadata.uri('http://purl.org/dc/elements/1.1/source'),
@@ -144,36 +728,106 @@ class LOCreditFormatter(libcredit.CreditFormatter):
             self.subject_stack.append(self.current_subject)
             self.current_subject = new_subject
 
+        self.uri_stack.append(subject_uri)
+
     def end(self):
         if self.metadata:
             self.current_subject = self.subject_stack.pop()
 
+        self.uri_stack.pop()
+
     def begin_sources(self, label=None):
-        self.add_text(" " + label)
-        self.text.insertControlCharacter(self.cursor, PARAGRAPH_BREAK, 0)
+        hidden = self.hidden > 0 or (
+            self.source_depth is not None and
+            len(self.sources_stack) >= self.source_depth)
+
+        entry = [hidden, 0, 0]
+        self.sources_stack.append(entry)
+
+        if hidden:
+            if not self.hidden:
+                entry[2] = self._count_sources(self.uri_stack[-1], 0)
+            self.hidden += 1
+        else:
+            self.add_text(" " + label)
+            self.text.insertControlCharacter(self.cursor, PARAGRAPH_BREAK, 0)
 
     def end_sources(self):
-        pass
+        hidden, count, below = self.sources_stack.pop()
+
+        if hidden:
+            self.hidden -= 1
+            if not self.hidden:
+                # Sources below the depth limit, summarize after the work
+                self.add_text(" " + self._more_sources_label(max(count, below)))
+        else:
+            skipped = count - self._visible_sources(count)
+            if skipped:
+                self.add_text(self._more_sources_label(skipped + below))
+                self.text.insertControlCharacter(self.cursor, PARAGRAPH_BREAK, 0)
 
     def begin_source(self):
-        pass
+        entry = self.sources_stack[-1]
+        entry[1] += 1
+
+        if self._source_skipped(entry):
+            self.skipped_entry = entry
+            self.hidden += 1
+
+    def _count_sources(self, subject_uri, default):
+        if self.source_counts is None:
+            return default
+        return self.source_counts.get(subject_uri, default)
 
     def end_source(self):
-        self.text.insertControlCharacter(self.cursor, PARAGRAPH_BREAK, 0)
+        if self._source_skipped(self.sources_stack[-1]):
+            self.hidden -= 1
+        elif not self.hidden:
+            self.text.insertControlCharacter(self.cursor, PARAGRAPH_BREAK, 0)
+
+    def _visible_sources(self, count):
+        if self.sources_per_level is None:
+            return count
+        return min(count, self.sources_per_level)
+
+    def _source_skipped(self, entry):
+        hidden, count, below = entry
+        return not hidden and count > self._visible_sources(count)
+
+    def _more_sources_label(self, count):
+        if count == 1:
+            return "+1 more source"
+        return "+{0} more sources".format(count)
 
     def add_title(self, token):
+        if token.url and not token.url_property:
+            # The URL may come from the subject, which is replaced by
+            # the bookmark, so record it for rewriting the caption
+            token = libcredit.CreditToken(
+                token.text, token.url, token.text_property,
+                'http://ogp.me/ns#url')
         self.add_token(token)
 
     def add_attrib(self, token):
+        if token.text and not token.text_property:
+            # Each of several creators gets its own token without a
+            # property, so record them as they were read
+            token = libcredit.CreditToken(
+                token.text, token.url, libcredit.DC['creator'],
+                token.url_property)
         self.add_token(token)
 
     def add_license(self, token):
         self.add_token(token)
 
     def add_text(self, text):
-        self.text.insertString(self.cursor, text, False)
+        if not self.hidden:
+            self.text.insertString(self.cursor, text, False)
 
     def add_token(self, token):
+        if self.hidden:
+            return
+
         length = len(token.text)
         self.text.insertString(self.cursor, token.text, False)
         self.cursor.goLeft(length, False)
@@ -202,6 +856,65 @@ class LOCreditFormatter(libcredit.CreditFormatter):
                 self.metadata.uri(token.url))
 
 
+class TeeCreditFormatter(libcredit.CreditFormatter):
+    """
+    Credit formatter that feeds a single traversal of the credit tree
+    into several formatters, each with its own source depth cutoff.
+
+    Sinks are (formatter, source_depth) pairs, where source_depth has
+    the same meaning as in libcredit.Credit.format().  Pass
+    source_depth to Credit.format() when formatting with the tee.
+    """
+    def __init__(self, *sinks):
+        self.sinks = sinks
+        self.level = 0
+
+        depths = [depth for formatter, depth in sinks]
+        if any(depth < 0 for depth in depths):
+            self.source_depth = -1
+        else:
+            self.source_depth = max(depths)
+
+    def _forward(self, method, *args, **kwargs):
+        for formatter, depth in self.sinks:
+            if depth < 0 or self.level <= depth:
+                getattr(formatter, method)(*args, **kwargs)
+
+    def begin(self, subject_uri=None):
+        self._forward('begin', subject_uri=subject_uri)
+
+    def end(self):
+        self._forward('end')
+
+    def begin_sources(self, label=None):
+        # Sources are listed one level below the current work, so only
+        # sinks that will print them should see the label
+        self.level += 1
+        self._forward('begin_sources', label)
+
+    def end_sources(self):
+        self._forward('end_sources')
+        self.level -= 1
+
+    def begin_source(self):
+        self._forward('begin_source')
+
+    def end_source(self):
+        self._forward('end_source')
+
+    def add_title(self, token):
+        self._forward('add_title', token)
+
+    def add_attrib(self, token):
+        self._forward('add_attrib', token)
+
+    def add_license(self, token):
+        self._forward('add_license', token)
+
+    def add_text(self, text):
+        self._forward('add_text', text)
+
+
 class Metadata(object):
     """Helper functions for working with the RDF metadata APIs"""
 
@@ -213,9 +926,14 @@ class Metadata(object):
         self.model = model
         self.repository = self.model.getRDFRepository()
 
-        # Load or create graph
+        # Set when rewriting credits, which would otherwise add the
+        # statements that aren't RDFa again
+        self.skip_duplicates = False
+
+        # Load or create graph, skipping the graphs of imported metadata
         type_uri = self.uri(self.GRAPH_TYPE_URI)
-        graph_uris = self.model.getMetadataGraphsWithType(type_uri)
+        graph_uris = [u for u in self.model.getMetadataGraphsWithType(type_uri)
+                      if u.StringValue.endswith(self.GRAPH_FILE)]
         if graph_uris:
             graph_uri = graph_uris[0]
         else:
@@ -233,8 +951,41 @@ class Metadata(object):
             "com.sun.star.rdf.Literal", (value, ))
 
     def add_statement(self, subject, predicate, obj):
+        if (self.skip_duplicates and
+            self.graph.getStatements(subject, predicate, obj).hasMoreElements()):
+            return
         self.graph.addStatement(subject, predicate, obj)
 
+    def import_graph(self, data):
+        """
+        Import RDF/XML data as a new metadata file, in one go.
+        Returns False if it couldn't be parsed.
+        """
+        stream = self.ctx.ServiceManager.createInstanceWithContext(
+            "com.sun.star.io.SequenceInputStream", self.ctx)
+        stream.initialize((uno.ByteSequence(data),))
+
+        file_name = 'metadata/source-{0}.rdf'.format(uuid.uuid4())
+        try:
+            self.model.importMetadataFile(
+                RDF_XML, stream, file_name, self.model,
+                (self.uri(self.GRAPH_TYPE_URI), ))
+        except (ParseException, IOException):
+            return False
+
+        return True
+
+    def set_credit_hash(self, subject, value):
+        self._set_value(subject, CREDIT_HASH_URI, value)
+
+    def set_image_hash(self, subject, value):
+        self._set_value(subject, IMAGE_HASH_URI, value)
+
+    def _set_value(self, subject, predicate_uri, value):
+        predicate = self.uri(predicate_uri)
+        self.graph.removeStatements(subject, predicate, None)
+        self.graph.addStatement(subject, predicate, self.literal(value))
+
     def add_rdfa_statements(self, subject, predicates, literal):
         self.repository.setStatementRDFa(subject, predicates, literal, '', None)
 
@@ -277,105 +1028,216 @@ class PasteWithCreditJob(unohelper.Base, XJobExecutor):
 
         image_with_metadata = self._get_image_with_metadata()
         if not image_with_metadata:
-            # just paste whatever is in clipboard
-            dispatch_helper = self.ctx.ServiceManager.createInstance(
-                "com.sun.star.frame.DispatchHelper");
-            dispatch_helper.executeDispatch(controller, ".uno:Paste", "", 0, tuple())
+            self._paste_plain(controller)
             return
 
-        rdf, descriptor, graphic = image_with_metadata
-        img_size = descriptor.getPropertyValue("SizePixel")
-
-        if model.supportsService("com.sun.star.text.TextDocument"):
-            # Metadata is only supported in text documents
-            metadata = Metadata(self.ctx, model)
-
-            # create a frame to hold the image with caption
-            text_frame = model.createInstance("com.sun.star.text.TextFrame")
-            text_frame.setSize(Size(15000,400))
-            text_frame.setPropertyValue("AnchorType", AT_PARAGRAPH)
-
-            # duplicate current cursor
-            view_cursor = controller.getViewCursor()
-            cursor = view_cursor.getText().createTextCursorByRange(view_cursor)
-            cursor.gotoStartOfSentence(False)
-            cursor.gotoEndOfSentence(True)
-
-            # insert text frame
-            text = model.Text
-            text.insertTextContent(cursor, text_frame, 0)
-            frame_text = text_frame.getText()
-
-            cursor = frame_text.createTextCursor()
-
-            # Add a <text:bookmark> tag to serve as anchor for the RDF
-            # and give us a subject URI.  Ideally, we would get this
-            # from the image but that isn't possible with current
-            # APIs.
-
-            bookmark = model.createInstance("com.sun.star.text.Bookmark")
-            frame_text.insertTextContent(cursor, bookmark, False)
-            bookmark.ensureMetadataReference()
-            bookmark.setName(BOOKMARK_BASE_NAME + bookmark.LocalName)
-            cursor.gotoEnd(False)
-
-            # create a TextGraphicObject to hold the image
-            image = model.createInstance("com.sun.star.text.TextGraphicObject")
-            image.setPropertyValue("Graphic", graphic)
-            # hack to enlarge the tiny pasted images
-            image.setPropertyValue("Width", img_size.Width * 20)
-            image.setPropertyValue("Height", img_size.Height * 20)
-            image.setName(bookmark.getName())
+        rdf, img = image_with_metadata
 
-            frame_text.insertTextContent(cursor, image, False)
+        downsample_size = None
+        if args == "downsample" and Image is not None:
+            max_width = DOWNSAMPLE_MAX_PIXELS
+            if model.supportsService("com.sun.star.text.TextDocument"):
+                max_width = min(max_width, DOWNSAMPLE_MAX_DPI * CAPTION_FRAME_WIDTH // 2540)
+            downsample_size = (max_width, DOWNSAMPLE_MAX_PIXELS)
 
-            # add the credit as text below the image
-            credit = libcredit.Credit(rdf)
-            credit_writer = LOCreditFormatter(frame_text, cursor, metadata = metadata)
-            credit.format(credit_writer, subject_uri = bookmark.StringValue)
-
-            # scale the image to fit the frame
-            image.setPropertyValue("RelativeWidth", 100)
-            #image.setPropertyValue("RelativeHeight", 100)
-            image.setPropertyValue("IsSyncHeightToWidth", True)
-
-            # set image title (no sources)
-            credit_writer = libcredit.TextCreditFormatter()
-            credit.format(credit_writer, source_depth=0)
-            image.setPropertyValue("Title", credit_writer.get_text())
-
-            # set image title (credit with sources)
-            credit_writer = libcredit.TextCreditFormatter()
-            credit.format(credit_writer)
-            image.setPropertyValue("Description", credit_writer.get_text())
-
-            # DEBUG:
-            # metadata.dump_graph()
-
-        elif model.supportsService("com.sun.star.presentation.PresentationDocument"):
-            page = controller.getCurrentPage()
-
-            # begin pasting
-            shape = model.createInstance("com.sun.star.drawing.GraphicObjectShape")
-            shape.Graphic = graphic
-            shape.setSize(Size(img_size.Width * 20, img_size.Height * 20))
-
-            page.add(shape)
-
-            attr = uno.createUnoStruct("com.sun.star.xml.AttributeData")
-            attr.Value = rdf
-
-            attributes = shape.UserDefinedAttributes
-            attributes.insertByName("cm-metadata", attr)
-            shape.UserDefinedAttributes = attributes
+        try:
+            credit = parse_credit(rdf)
+        except CreditError:
+            self._paste_plain(controller)
+            return
 
-            size = shape.Size
-            shape.setPosition(Point(
-                int((page.Width - size.Width) / 2),
-                int((page.Height - size.Height) / 2))
-            )
+        # Object whose graphic is replaced when the image has been
+        # scaled down, and the bookmark to record the original size on
+        target = None
+        bookmark = None
+        metadata = None
+
+        with edit_batch(model, "Paste with credits"):
+            if model.supportsService("com.sun.star.text.TextDocument"):
+                # Metadata is only supported in text documents
+                metadata = Metadata(self.ctx, model)
+
+                # create a frame to hold the image with caption
+                text_frame = model.createInstance("com.sun.star.text.TextFrame")
+                text_frame.setSize(Size(CAPTION_FRAME_WIDTH,400))
+                text_frame.setPropertyValue("AnchorType", AT_PARAGRAPH)
+
+                # duplicate current cursor
+                view_cursor = controller.getViewCursor()
+                cursor = view_cursor.getText().createTextCursorByRange(view_cursor)
+                cursor.gotoStartOfSentence(False)
+                cursor.gotoEndOfSentence(True)
+
+                # insert text frame
+                text = model.Text
+                text.insertTextContent(cursor, text_frame, 0)
+                frame_text = text_frame.getText()
+
+                cursor = frame_text.createTextCursor()
+
+                # Add a <text:bookmark> tag to serve as anchor for the RDF
+                # and give us a subject URI.  Ideally, we would get this
+                # from the image but that isn't possible with current
+                # APIs.
+
+                bookmark = model.createInstance("com.sun.star.text.Bookmark")
+                frame_text.insertTextContent(cursor, bookmark, False)
+                bookmark.ensureMetadataReference()
+                bookmark.setName(BOOKMARK_BASE_NAME + bookmark.LocalName)
+                cursor.gotoEnd(False)
+
+                img_size, graphic, downsampled, img_hash = self._load_image(
+                    img, downsample_size)
+                if downsampled:
+                    self._set_original_size(metadata, bookmark, img_size)
+
+                # Lets CopyWithMetadataJob find the image data in the
+                # document package
+                metadata.set_image_hash(bookmark, img_hash)
+
+                # create a TextGraphicObject to hold the image
+                image = model.createInstance("com.sun.star.text.TextGraphicObject")
+                image.setPropertyValue("Graphic", graphic)
+                # hack to enlarge the tiny pasted images
+                image.setPropertyValue("Width", img_size.Width * 20)
+                image.setPropertyValue("Height", img_size.Height * 20)
+                image.setName(bookmark.getName())
+
+                frame_text.insertTextContent(cursor, image, False)
+                target = image
+
+                # Keep the entire source chain in the document, even
+                # though only part of it is written in the caption
+                metadata.import_graph(rdf)
+
+                write_credit(credit, frame_text, cursor, image, metadata, bookmark)
+
+                # scale the image to fit the frame
+                image.setPropertyValue("RelativeWidth", 100)
+                #image.setPropertyValue("RelativeHeight", 100)
+                image.setPropertyValue("IsSyncHeightToWidth", True)
+
+                # Remember what the caption was written from, so that
+                # RefreshCreditsJob can tell if it needs updating
+                metadata.set_credit_hash(bookmark, provenance_hash(
+                    get_closure_graph(metadata.repository, bookmark),
+                    rdflib.URIRef(bookmark.StringValue)))
+
+                # DEBUG:
+                # metadata.dump_graph()
+
+            elif model.supportsService("com.sun.star.presentation.PresentationDocument"):
+                page = controller.getCurrentPage()
+                img_size, graphic, downsampled, img_hash = self._load_image(
+                    img, downsample_size)
+
+                # begin pasting
+                shape = model.createInstance("com.sun.star.drawing.GraphicObjectShape")
+                shape.Graphic = graphic
+                shape.setSize(Size(img_size.Width * 20, img_size.Height * 20))
+
+                page.add(shape)
+                target = shape
+
+                # The attribute is a string, and the clipboard data can
+                # be in any encoding
+                attr = uno.createUnoStruct("com.sun.star.xml.AttributeData")
+                attr.Value = decode_rdf(rdf)
+                if downsampled:
+                    attr.Value = add_original_size(attr.Value, img_size)
+
+                attributes = shape.UserDefinedAttributes
+                attributes.insertByName("cm-metadata", attr)
+                shape.UserDefinedAttributes = attributes
+
+                size = shape.Size
+                shape.setPosition(Point(
+                    int((page.Width - size.Width) / 2),
+                    int((page.Height - size.Height) / 2))
+                )
+
+        if downsample_size is not None and target is not None and not downsampled:
+            # The original image is pasted right away, and replaced
+            # when it has been scaled down
+            self._downsample_later(model, img, downsample_size, target, metadata, bookmark)
+
+    def _paste_plain(self, controller):
+        # just paste whatever is in clipboard
+        dispatch_helper = self.ctx.ServiceManager.createInstance(
+            "com.sun.star.frame.DispatchHelper");
+        dispatch_helper.executeDispatch(controller, ".uno:Paste", "", 0, tuple())
+
+    # returns a tuple consisting of (Size, Graphic, bool, str), where Size is
+    # the pixel size of the original image, bool is True if it was downsampled,
+    # which is only the case if the same image has been scaled down before,
+    # and str is the SHA-1 of the data of the graphic
+    def _load_image(self, img, downsample_size):
+        if downsample_size is not None:
+            cached = get_cached_graphic(
+                downsampled_graphic_key(img.value, downsample_size))
+            if cached is not None:
+                img_size, graphic, img_hash = cached
+                return (img_size, graphic, True, img_hash)
+
+        img_size, graphic = load_graphic(self.ctx, img)
+        return (img_size, graphic, False, hashlib.sha1(img.value).hexdigest())
+
+    def _downsample_later(self, model, img, max_size, target, metadata, bookmark):
+        """
+        Scale img down in a worker thread, and replace the graphic of
+        target with it when done.  The original size is recorded on
+        bookmark if given, or else in the metadata of the target shape.
+        """
+        key = downsampled_graphic_key(img.value, max_size)
+
+        def replace_graphic(downsampler):
+            if downsampler.data is None:
+                return
 
-    # returns a tuple consisting of (str, GraphicDescriptor, Graphic) or None
+            try:
+                scaled_size, graphic = decode_graphic(
+                    self.ctx, uno.ByteSequence(downsampler.data))
+                img_size = Size(*downsampler.original_size)
+                img_hash = hashlib.sha1(downsampler.data).hexdigest()
+                cache_graphic(key, (img_size, graphic, img_hash), scaled_size)
+
+                # The user pasted a reduced size image, so this isn't
+                # a separate change to undo
+                undo_manager = model.getUndoManager()
+                undo_manager.lock()
+                try:
+                    target.setPropertyValue("Graphic", graphic)
+                    if bookmark is not None:
+                        self._set_original_size(metadata, bookmark, img_size)
+                        metadata.set_image_hash(bookmark, img_hash)
+                    else:
+                        self._set_shape_original_size(target, img_size)
+                finally:
+                    undo_manager.unlock()
+            except Exception:
+                # The document or the image may be gone by now, in
+                # which case the original image is all there is
+                pass
+
+        ImageDownsampler(img.value, max_size, replace_graphic).start()
+
+    def _set_original_size(self, metadata, bookmark, img_size):
+        # Keep track of the size of the pasted image
+        metadata.add_statement(
+            bookmark, metadata.uri(ORIGINAL_WIDTH_URI),
+            metadata.literal(str(img_size.Width)))
+        metadata.add_statement(
+            bookmark, metadata.uri(ORIGINAL_HEIGHT_URI),
+            metadata.literal(str(img_size.Height)))
+
+    def _set_shape_original_size(self, shape, img_size):
+        attributes = shape.UserDefinedAttributes
+        attr = attributes.getByName("cm-metadata")
+        attr.Value = add_original_size(attr.Value, img_size)
+        attributes.replaceByName("cm-metadata", attr)
+        shape.UserDefinedAttributes = attributes
+
+    # returns a tuple consisting of (bytes, ByteSequence) or None
     def _get_image_with_metadata(self):
         clip = self.ctx.ServiceManager.createInstanceWithContext(
             "com.sun.star.datatransfer.clipboard.SystemClipboard", self.ctx)
@@ -383,34 +1245,20 @@ class PasteWithCreditJob(unohelper.Base, XJobExecutor):
         contents = clip.getContents()
         data_flavors = contents.getTransferDataFlavors()
         mimeTypes = [d.MimeType for d in data_flavors]
+        img_clip = find_image_flavor(data_flavors)
 
-        if "image/png" in mimeTypes and "application/rdf+xml" in mimeTypes:
+        if img_clip is not None and "application/rdf+xml" in mimeTypes:
             rdf_clip = next(d for d in data_flavors if d.MimeType == "application/rdf+xml")
-            rdf = clip.getContents().getTransferData(rdf_clip).value
-
-            # We might get both UTF-8 and UTF-16 here.
-            try:
-                rdf = rdf.decode('utf-8')
-            except UnicodeError:
-                rdf = rdf.decode('utf-16')
-
-            img_clip = next(d for d in data_flavors if d.MimeType == "image/png")
-            img = clip.getContents().getTransferData(img_clip)
+            rdf = contents.getTransferData(rdf_clip).value
 
-            img_stream = self.ctx.ServiceManager.createInstanceWithContext(
-                "com.sun.star.io.SequenceInputStream", self.ctx)
-            img_stream.initialize((img,))
-            graphic_provider = self.ctx.ServiceManager.createInstanceWithContext(
-                "com.sun.star.graphic.GraphicProvider", self.ctx)
+            # Don't even try to parse unreasonable amounts of metadata.
+            # It is kept as bytes, since we might get both UTF-8 and
+            # UTF-16 here and the XML parser knows best how to decode it.
+            if len(rdf) > MAX_RDF_SIZE:
+                return None
 
-            stream_property = PropertyValue()
-            stream_property.Name = "InputStream"
-            stream_property.Value = img_stream
-
-            descriptor = graphic_provider.queryGraphicDescriptor((stream_property,))
-            graphic = graphic_provider.queryGraphic((stream_property,))
-            #size = descriptor.getPropertyValue("SizePixel")
-            return (rdf, descriptor, graphic)
+            img = contents.getTransferData(img_clip)
+            return (rdf, img)
 
         return None
 
@@ -426,8 +1274,66 @@ class InsertCreditsJob(unohelper.Base, XJobExecutor):
 
         model = desktop.getCurrentComponent()
         controller = model.getCurrentController()
-        presentation = model.Presentation
 
+        if model.supportsService("com.sun.star.text.TextDocument"):
+            self._insert_text_credits(model, controller)
+        elif model.supportsService("com.sun.star.presentation.PresentationDocument"):
+            self._insert_presentation_credits(model, controller)
+
+    def _insert_text_credits(self, model, controller):
+        # Read all metadata in one go instead of querying each image
+        graph = get_repository_graph(model.getRDFRepository())
+
+        lines = []
+        seen_works = set()
+
+        bookmarks = model.getBookmarks()
+        for name in bookmarks.getElementNames():
+            if not name.startswith(BOOKMARK_BASE_NAME):
+                continue
+
+            subject = rdflib.URIRef(bookmarks.getByName(name).StringValue)
+            if (subject, None, None) not in graph:
+                continue
+
+            # The same work may have been pasted several times, and then
+            # has the same statements.  Different works can still have
+            # the same credit text, so don't compare that.
+            work = frozenset(
+                (predicate, obj)
+                for predicate, obj in graph.predicate_objects(subject)
+                if not predicate.startswith(PASTE_NS))
+            if work in seen_works:
+                continue
+            seen_works.add(work)
+
+            try:
+                credit = get_document_credit(graph, subject)
+            except CreditError:
+                continue
+
+            credit_writer = libcredit.TextCreditFormatter()
+            credit.format(credit_writer, source_depth=0)
+            lines.append(credit_writer.get_text())
+
+        if not lines:
+            return
+
+        with edit_batch(model, "Insert credits"):
+            view_cursor = controller.getViewCursor()
+            text = view_cursor.getText()
+            cursor = text.createTextCursorByRange(view_cursor)
+
+            # Insert the whole list at once, CR starts a new paragraph.
+            # The list gets paragraphs of its own, even if the cursor
+            # is in the middle of one.
+            paragraphs = ["This document includes the following works:", ""] + lines
+            if not cursor.isStartOfParagraph():
+                paragraphs.insert(0, "")
+
+            text.insertString(cursor, "\r".join(paragraphs) + "\r", False)
+
+    def _insert_presentation_credits(self, model, controller):
         pages = model.getDrawPages()
         credits = []
         for page_num in range(pages.getCount()):
@@ -436,54 +1342,147 @@ class InsertCreditsJob(unohelper.Base, XJobExecutor):
                 shape = page.getByIndex(shape_num)
                 try:
                     rdf = shape.UserDefinedAttributes.getByName("cm-metadata").Value
-                    credit = libcredit.Credit(rdf)
+                    credit = parse_credit(rdf.encode('utf-8'))
                     credits.append(credit)
-                except NoSuchElementException:
+                except (NoSuchElementException, CreditError):
                     pass
 
-        # create a TextShape with credits on the current page
-        page = controller.getCurrentPage()
-        shape = model.createInstance("com.sun.star.drawing.TextShape")
-        shape.TextAutoGrowHeight = True
-        shape.TextAutoGrowWidth = True
-
-        page.add(shape)
-
-        text = shape.Text
-        cursor = text.createTextCursor()
-        text.insertString(cursor, "This presentation includes the following works:", 0)
-        text.insertControlCharacter(cursor, PARAGRAPH_BREAK, 0)
-        text.insertControlCharacter(cursor, PARAGRAPH_BREAK, 0)
-        cursor.gotoEnd(False)
-
-        for credit in credits:
-            # in Impress cursor seems to support com.sun.star.style.CharacterProperties
-            # but trying to set HyperLinkURL property raises an UnknownPropertyException
-            # so let's just disable hyperlinks for now
-            tf = LOCreditFormatter(text, cursor, hyperlinks=False)
-            credit.format(tf, source_depth=0)
+        with edit_batch(model, "Insert credits"):
+            # create a TextShape with credits on the current page
+            page = controller.getCurrentPage()
+            shape = model.createInstance("com.sun.star.drawing.TextShape")
+            shape.TextAutoGrowHeight = True
+            shape.TextAutoGrowWidth = True
+
+            page.add(shape)
+
+            text = shape.Text
+            cursor = text.createTextCursor()
+            text.insertString(cursor, "This presentation includes the following works:", 0)
+            text.insertControlCharacter(cursor, PARAGRAPH_BREAK, 0)
             text.insertControlCharacter(cursor, PARAGRAPH_BREAK, 0)
+            cursor.gotoEnd(False)
+
+            for credit in credits:
+                # in Impress cursor seems to support com.sun.star.style.CharacterProperties
+                # but trying to set HyperLinkURL property raises an UnknownPropertyException
+                # so let's just disable hyperlinks for now
+                tf = LOCreditFormatter(text, cursor, hyperlinks=False)
+                credit.format(tf, source_depth=0)
+                text.insertControlCharacter(cursor, PARAGRAPH_BREAK, 0)
+
+            size = shape.Size
+            shape.setPosition(Point(
+                int((page.Width - size.Width) / 2),
+                int((page.Height - size.Height) / 2))
+            )
+
 
-        size = shape.Size
-        shape.setPosition(Point(
-            int((page.Width - size.Width) / 2),
-            int((page.Height - size.Height) / 2))
-        )
+class RefreshCreditsJob(unohelper.Base, XJobExecutor):
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    def trigger(self, args):
+        desktop = self.ctx.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", self.ctx)
+
+        model = desktop.getCurrentComponent()
+        if not model.supportsService("com.sun.star.text.TextDocument"):
+            return
+
+        metadata = Metadata(self.ctx, model)
+
+        # Read all metadata in one go, and only touch the captions
+        # whose metadata no longer matches the stored hash
+        graph = get_repository_graph(metadata.repository)
+
+        changed = []
+        unhashed = []
+        bookmarks = model.getBookmarks()
+        for name in bookmarks.getElementNames():
+            if not name.startswith(BOOKMARK_BASE_NAME):
+                continue
+
+            subject = rdflib.URIRef(bookmarks.getByName(name).StringValue)
+            if (subject, None, None) not in graph:
+                continue
+
+            stored_hash = graph.value(subject, CREDIT_HASH)
+            if stored_hash is None:
+                # Pasted before hashes were recorded, and possibly
+                # without all the metadata needed to rewrite it, so
+                # keep the caption and start tracking it from here
+                unhashed.append(name)
+            elif str(stored_hash) != provenance_hash(graph, subject):
+                try:
+                    credit = get_document_credit(graph, subject)
+                except CreditError:
+                    # Keep the caption, the sources can't be credited
+                    continue
+                changed.append((name, credit))
+
+        for name in unhashed:
+            bookmark = bookmarks.getByName(name)
+            metadata.set_credit_hash(bookmark, provenance_hash(
+                graph, rdflib.URIRef(bookmark.StringValue)))
+
+        if not changed:
+            return
+
+        graphics = model.getGraphicObjects()
+        metadata.skip_duplicates = True
+
+        with edit_batch(model, "Update credits"):
+            for name, credit in changed:
+                bookmark = bookmarks.getByName(name)
+                try:
+                    image = graphics.getByName(name)
+                except NoSuchElementException:
+                    continue
+
+                # The caption is everything in the frame after the
+                # bookmark and the image.  Deleting it leaves the
+                # bookmark alone, since that is collapsed at the start.
+                if image.AnchorType == AS_CHARACTER:
+                    start = image.getAnchor().getEnd()
+                else:
+                    start = bookmark.getAnchor().getEnd()
+
+                frame_text = start.getText()
+                cursor = frame_text.createTextCursorByRange(start)
+                cursor.gotoEnd(True)
+                cursor.setString("")
+
+                write_credit(credit, frame_text, cursor, image, metadata, bookmark)
+
+                metadata.set_credit_hash(bookmark, provenance_hash(
+                    get_closure_graph(metadata.repository, bookmark),
+                    rdflib.URIRef(bookmark.StringValue)))
 
 
 class ImageWithMetadataTransferable(unohelper.Base, XTransferable):
-    def __init__(self, img_data, rdf_data):
+    """
+    Transferable with RDF metadata and the image in one or more formats.
+
+    images is a list of (mime_type, data) tuples in order of preference.
+    data can also be a function returning the image data, which is then
+    only called if that format is requested.
+    """
+    def __init__(self, images, rdf_data):
         self._rdf_type = "application/rdf+xml"
-        self._img_type = "image/png"
 
-        self._img_data = img_data
+        self._img_types = [mime_type for mime_type, data in images]
+        self._img_data = dict(images)
         self._rdf_data = rdf_data.encode("utf-8")
 
     def getTransferData(self, flavor):
         if flavor.MimeType == self._rdf_type:
             return uno.ByteSequence(self._rdf_data)
-        if flavor.MimeType == self._img_type:
-            return uno.ByteSequence(self._img_data)
+        if flavor.MimeType in self._img_data:
+            data = self._img_data[flavor.MimeType]
+            if callable(data):
+                data = self._img_data[flavor.MimeType] = data()
+            return uno.ByteSequence(data)
 
     def getTransferDataFlavors(self):
         df_rdf = DataFlavor()
@@ -492,16 +1491,19 @@ class ImageWithMetadataTransferable(unohelper.Base, XTransferable):
         #df_rdf.DataType = uno.getTypeByName("[]byte")
         df_rdf.DataType = uno.getTypeByName("string")
 
-        df_img = DataFlavor()
-        df_img.MimeType = self._img_type
-        df_img.HumanPresentableName = ""
-        df_img.DataType = uno.getTypeByName("[]byte")
+        flavors = [df_rdf]
+        for mime_type in self._img_types:
+            df_img = DataFlavor()
+            df_img.MimeType = mime_type
+            df_img.HumanPresentableName = ""
+            df_img.DataType = uno.getTypeByName("[]byte")
+            flavors.append(df_img)
 
-        return (df_rdf, df_img)
+        return tuple(flavors)
 
     def isDataFlavorSupported(self, flavor):
         return flavor.MimeType == self._rdf_type or \
-               flavor.MimeType == self._img_type
+               flavor.MimeType in self._img_data
 
 
 class ImageWithMetadataClipboardOwner(unohelper.Base, XClipboardOwner):
@@ -528,38 +1530,90 @@ class CopyWithMetadataJob(unohelper.Base, XJobExecutor):
 
         if selection.supportsService("com.sun.star.text.TextGraphicObject") and selection.getName():
             img_name = selection.getName()
+            graphic = selection.Graphic
+
+            # Offer the image in the format it was pasted in, and as PNG
+            # for applications that don't understand that format.  The
+            # PNG is only generated if it is asked for.
+            images = []
+            native_type = graphic.MimeType
+            if native_type in IMAGE_MIME_TYPES:
+                img_data = self._get_stored_image(model, img_name)
+                if img_data is None:
+                    img_data = self._store_graphic(graphic, native_type)
+                images.append((native_type, img_data))
+            if native_type != "image/png":
+                images.append(("image/png", lambda: self._store_graphic(graphic, "image/png")))
 
-            # use tempfile to export graphic
-            temp = tempfile.NamedTemporaryFile(delete=False)
+            img_metadata = get_image_metadata(self.ctx, model, img_name)
 
-            url_property = PropertyValue()
-            url_property.Name = "URL"
-            url_property.Value = "file:///" + temp.name
+            img_transferable = ImageWithMetadataTransferable(images, img_metadata)
+            self.clip_owner = ImageWithMetadataClipboardOwner()
+            clip = self.ctx.ServiceManager.createInstanceWithContext(
+                "com.sun.star.datatransfer.clipboard.SystemClipboard", self.ctx)
+            clip.setContents(img_transferable, self.clip_owner)
 
-            # sadly, OutputStream doesn't work
-            #stream_property = PropertyValue()
-            #stream_property.Name = "OutputStream"
-            #stream_property.Value = out_stream
+    def _get_stored_image(self, model, img_name):
+        """
+        Return the image data as it was pasted, by looking up the hash
+        recorded for img_name in the Pictures folder of the document
+        package.  Returns None if it isn't there, for example if the
+        document hasn't been saved since the image was pasted.
+        """
+        repository = model.getRDFRepository()
+        bookmark = model.getBookmarks().getByName(img_name)
+        statements = repository.getStatements(
+            bookmark, uri(self.ctx, IMAGE_HASH_URI), None)
+        if not statements.hasMoreElements():
+            return None
+        img_hash = statements.nextElement().Object.Value
+
+        storage = model.getDocumentStorage()
+        if not storage.hasByName("Pictures"):
+            return None
+
+        pictures = storage.openStorageElement("Pictures", READ)
+        try:
+            for name in pictures.getElementNames():
+                stream = pictures.openStreamElement(name, READ)
+                try:
+                    data = read_stream(stream.getInputStream())
+                finally:
+                    stream.dispose()
 
-            mime_property = PropertyValue()
-            mime_property.Name = "MimeType"
-            mime_property.Value = "image/png"
+                if hashlib.sha1(data).hexdigest() == img_hash:
+                    return data
+        finally:
+            pictures.dispose()
 
-            graphic_provider = self.ctx.ServiceManager.createInstanceWithContext(
-                "com.sun.star.graphic.GraphicProvider", self.ctx)
-            graphic_provider.storeGraphic(selection.Graphic, (url_property, mime_property))
+        return None
 
-            temp.close()
-            img_data = open(temp.name, "rb").read()
-            os.unlink(temp.name)
+    def _store_graphic(self, graphic, mime_type):
+        # use tempfile to export graphic
+        temp = tempfile.NamedTemporaryFile(delete=False)
 
-            img_metadata = get_image_metadata(self.ctx, model, img_name)
+        url_property = PropertyValue()
+        url_property.Name = "URL"
+        url_property.Value = "file:///" + temp.name
 
-            img_transferable = ImageWithMetadataTransferable(img_data, img_metadata)
-            self.clip_owner = ImageWithMetadataClipboardOwner()
-            clip = self.ctx.ServiceManager.createInstanceWithContext(
-                "com.sun.star.datatransfer.clipboard.SystemClipboard", self.ctx)
-            clip.setContents(img_transferable, self.clip_owner)
+        # sadly, OutputStream doesn't work
+        #stream_property = PropertyValue()
+        #stream_property.Name = "OutputStream"
+        #stream_property.Value = out_stream
+
+        mime_property = PropertyValue()
+        mime_property.Name = "MimeType"
+        mime_property.Value = mime_type
+
+        graphic_provider = self.ctx.ServiceManager.createInstanceWithContext(
+            "com.sun.star.graphic.GraphicProvider", self.ctx)
+        graphic_provider.storeGraphic(graphic, (url_property, mime_property))
+
+        temp.close()
+        img_data = open(temp.name, "rb").read()
+        os.unlink(temp.name)
+
+        return img_data
 
 
 class ContextInterceptor(unohelper.Base, XContextMenuInterceptor):
@@ -582,9 +1636,10 @@ class ContextInterceptor(unohelper.Base, XContextMenuInterceptor):
         if canPasteText or canPastePresentation:
             clip = self.ctx.ServiceManager.createInstanceWithContext(
                 "com.sun.star.datatransfer.clipboard.SystemClipboard", self.ctx)
-            mimeTypes = [d.MimeType for d in clip.getContents().getTransferDataFlavors()]
+            data_flavors = clip.getContents().getTransferDataFlavors()
+            mimeTypes = [d.MimeType for d in data_flavors]
 
-            if "image/png" in mimeTypes and "application/rdf+xml" in mimeTypes:
+            if find_image_flavor(data_flavors) is not None and "application/rdf+xml" in mimeTypes:
                 item = menu.createInstance("com.sun.star.ui.ActionTrigger")
                 item.setPropertyValue("Text", "Paste with credits")
                 item.setPropertyValue("CommandURL", u"se.commonsmachinery.extensions.paste_with_credit.Menu:PasteWithCredit")
@@ -680,6 +1735,12 @@ g_ImplementationHelper.addImplementation(
     ("com.sun.star.task.Job",)
 )
 
+g_ImplementationHelper.addImplementation(
+    RefreshCreditsJob,
+    "se.commonsmachinery.extensions.paste_with_credit.RefreshCreditsJob",
+    ("com.sun.star.task.Job",)
+)
+
 g_ImplementationHelper.addImplementation(
     CopyWithMetadataJob,
     "se.commonsmachinery.extensions.paste_with_credit.CopyWithMetadataJob",
@@ -736,6 +1797,10 @@ if __name__ == "__main__":
         job = InsertCreditsJob(ctx)
         job.trigger(None)
 
+    elif cmd == 'refresh':
+        job = RefreshCreditsJob(ctx)
+        job.trigger(None)
+
     else:
         print("unknown command", cmd)
 